@@ -1,3 +1,4 @@
+from datetime import datetime, timezone
 from db import DataAccessLayer
 from flask import Flask, request
 from flask.json import jsonify
@@ -5,9 +6,18 @@ from os import environ
 from sqlalchemy import desc
 from sqlalchemy.orm import validates
 from sqlalchemy.sql import func
+from werkzeug.http import parse_etags
+import gzip
+import hashlib
 import json
 import time
 
+# Brotli is optional, responses fall back to gzip when it is not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # Setup python flask configuration
 app = Flask(__name__)
 app.config.from_object('configmodule.Config')
@@ -80,6 +90,95 @@ class SensorData(dal.db.Model):
                 reading_dict[c.name] = getattr(self, c.name)
         return reading_dict
 
+# Change marker Model, bumped on every reading ingested for a device and type
+class DeviceMarker(dal.db.Model):
+    __tablename__ = "device_markers"
+
+    device_uuid =   dal.db.Column(dal.db.Text, primary_key = True)
+    sensor_type =   dal.db.Column('type', dal.db.Text, primary_key = True)
+    sequence =      dal.db.Column(dal.db.Integer, nullable = False, default = 0)
+    last_modified = dal.db.Column(dal.db.Integer, nullable = False)
+
+def touch_device_marker(device_uuid, sensor_type):
+    """
+    Bump the change marker for a device and sensor type within the current session.
+    The caller is responsible for committing alongside the reading itself.
+    """
+    now = int(time.time())
+    updated = DeviceMarker.query.filter(DeviceMarker.device_uuid == device_uuid, DeviceMarker.sensor_type == sensor_type) \
+        .update({ DeviceMarker.sequence: DeviceMarker.sequence + 1, DeviceMarker.last_modified: now }, synchronize_session = False)
+    if 0 == updated:
+        dal.db.session.add(DeviceMarker(device_uuid = device_uuid, sensor_type = sensor_type, sequence = 1, last_modified = now))
+
+def device_validators(device_uuid, sensor_type = None):
+    """
+    Compute the ETag and Last-Modified validators for the current request from the
+    device change markers, without touching the readings table.
+
+    Returns (None, None) when no marker exists yet for the device (and type).
+    """
+    query = dal.db.session.query(func.sum(DeviceMarker.sequence), func.max(DeviceMarker.last_modified)) \
+        .filter(DeviceMarker.device_uuid == device_uuid)
+    if sensor_type:
+        query = query.filter(DeviceMarker.sensor_type == sensor_type)
+
+    sequence, last_modified = query.first()
+    if sequence is None:
+        return None, None
+
+    # Query parameters arrive in the body, so they are part of the tag
+    digest = hashlib.sha1()
+    digest.update(request.path.encode('utf-8'))
+    digest.update(request.data or b'')
+    digest.update(str(sequence).encode('utf-8'))
+    return digest.hexdigest(), datetime.fromtimestamp(last_modified, timezone.utc).replace(tzinfo = None)
+
+def not_modified(etag):
+    """
+    Only If-None-Match is honored. Last-Modified is informational: it neither covers
+    the query parameters sent in the body nor distinguishes writes within one second.
+    """
+    return etag is not None and parse_etags(request.headers.get('If-None-Match')).contains_weak(etag)
+
+def not_modified_response(etag, last_modified):
+    response = with_validators(app.response_class(status = 304), etag, last_modified)
+    response.vary.add('Accept-Encoding')
+    return response
+
+def with_validators(response, etag, last_modified):
+    # Weak tags, as the body may be served with different content encodings
+    if etag:
+        response.set_etag(etag, weak = True)
+        response.last_modified = last_modified
+    return response
+
+@app.after_request
+def compress_response(response):
+    """
+    Compress JSON bodies over COMPRESSION_MIN_SIZE bytes when the client accepts it,
+    preferring brotli when available.
+    """
+    if 200 != response.status_code or 'application/json' != response.mimetype \
+        or response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < app.config['COMPRESSION_MIN_SIZE']:
+        return response
+
+    encodings = ['br', 'gzip'] if brotli else ['gzip']
+    encoding = request.accept_encodings.best_match(encodings)
+    if 'br' == encoding:
+        response.set_data(brotli.compress(data, quality = app.config['BROTLI_QUALITY']))
+    elif 'gzip' == encoding:
+        response.set_data(gzip.compress(data, compresslevel = app.config['COMPRESSION_LEVEL']))
+    else:
+        return response
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
 @app.route('/devices/<string:device_uuid>/readings/', methods = ['POST', 'GET'])
 def request_device_readings(device_uuid):
     """
@@ -113,6 +212,7 @@ def request_device_readings(device_uuid):
 
         try:
             dal.db.session.add(reading)
+            touch_device_marker(device_uuid, reading.sensor_type)
             dal.db.session.commit()
             return 'success', 201
         except Exception as e:
@@ -136,6 +236,10 @@ def request_device_readings(device_uuid):
             return str(e), 400
         body_data = json.loads(request.data) if request.data else {}
 
+        etag, last_modified = device_validators(device_uuid, body_data.get('type'))
+        if not_modified(etag):
+            return not_modified_response(etag, last_modified)
+
         query = SensorData.query.filter(SensorData.device_uuid == device_uuid) 
         if body_data.get('type', None):
             query = query.filter(SensorData.sensor_type == body_data.get('type'))
@@ -145,7 +249,7 @@ def request_device_readings(device_uuid):
             query = query.filter(SensorData.date_created <= body_data.get('end'))
 
         rows = query.all()
-        return jsonify([row.as_dict() for row in rows]), 200
+        return with_validators(jsonify([row.as_dict() for row in rows]), etag, last_modified), 200
 
 # Returns single sensor reading dictionary: { date_created, device_uuid, type, value }
 @app.route('/devices/<string:device_uuid>/readings/min/', methods = ['GET'])
@@ -172,6 +276,11 @@ def request_device_readings_min(device_uuid):
 
     body_data = json.loads(request.data)
 
+    # Computed across every sensor type of the device
+    etag, last_modified = device_validators(device_uuid)
+    if not_modified(etag):
+        return not_modified_response(etag, last_modified)
+
     session = dal.Session()
     subquery = session.query(func.min(SensorData.value)).filter(SensorData.device_uuid == device_uuid)
     if body_data.get('start', None):
@@ -189,7 +298,7 @@ def request_device_readings_min(device_uuid):
     query = query.order_by(SensorData.date_created.desc())
 
     row = query.first()
-    return jsonify(row.as_dict()), 200
+    return with_validators(jsonify(row.as_dict()), etag, last_modified), 200
 
 @app.route('/devices/<string:device_uuid>/readings/max/', methods = ['GET'])
 def request_device_readings_max(device_uuid):
@@ -214,6 +323,11 @@ def request_device_readings_max(device_uuid):
 
     body_data = json.loads(request.data)
 
+    # Computed across every sensor type of the device
+    etag, last_modified = device_validators(device_uuid)
+    if not_modified(etag):
+        return not_modified_response(etag, last_modified)
+
     session = dal.Session()
     subquery = session.query(func.max(SensorData.value)).filter(SensorData.device_uuid == device_uuid)
     if body_data.get('start', None):
@@ -230,7 +344,7 @@ def request_device_readings_max(device_uuid):
     query = query.order_by(SensorData.date_created.desc())
 
     row = query.first()
-    return jsonify(row.as_dict()), 200
+    return with_validators(jsonify(row.as_dict()), etag, last_modified), 200
 
 @app.route('/devices/<string:device_uuid>/readings/median/', methods = ['GET'])
 def request_device_readings_median(device_uuid):
@@ -256,6 +370,10 @@ def request_device_readings_median(device_uuid):
 
     body_data = json.loads(request.data)
 
+    etag, last_modified = device_validators(device_uuid, body_data.get('type'))
+    if not_modified(etag):
+        return not_modified_response(etag, last_modified)
+
     subquery = SensorData.query.filter(SensorData.device_uuid == device_uuid, SensorData.sensor_type == body_data.get('type'))
     if body_data.get('start', None):
         subquery = subquery.filter(SensorData.date_created >= body_data.get('start'))
@@ -281,7 +399,7 @@ def request_device_readings_median(device_uuid):
         query = query.order_by(SensorData.value).limit(1).offset(count // 2)
         row = query.first()
 
-    return jsonify(row.as_dict()), 200
+    return with_validators(jsonify(row.as_dict()), etag, last_modified), 200
 
 @app.route('/devices/<string:device_uuid>/readings/mean/', methods = ['GET'])
 def request_device_readings_mean(device_uuid):
@@ -307,6 +425,10 @@ def request_device_readings_mean(device_uuid):
 
     body_data = json.loads(request.data)
 
+    etag, last_modified = device_validators(device_uuid, body_data.get('type'))
+    if not_modified(etag):
+        return not_modified_response(etag, last_modified)
+
     session = dal.Session()
     query = session.query(func.avg(SensorData.value)).filter(SensorData.device_uuid == device_uuid).filter(SensorData.sensor_type == body_data.get('type'))
     if body_data.get('start', None):
@@ -315,7 +437,7 @@ def request_device_readings_mean(device_uuid):
         query = query.filter(SensorData.date_created <= body_data.get('end'))
 
     row = query.first()
-    return jsonify({ 'value': row[0] }), 200
+    return with_validators(jsonify({ 'value': row[0] }), etag, last_modified), 200
 
 @app.route('/devices/<string:device_uuid>/readings/mode/', methods = ['GET'])
 def request_device_readings_mode(device_uuid):
@@ -341,6 +463,10 @@ def request_device_readings_mode(device_uuid):
 
     body_data = json.loads(request.data)
 
+    etag, last_modified = device_validators(device_uuid, body_data.get('type'))
+    if not_modified(etag):
+        return not_modified_response(etag, last_modified)
+
     session = dal.Session()
     query = session.query(SensorData.value, func.count(SensorData.value).label('total')).filter(SensorData.device_uuid == device_uuid).filter(SensorData.sensor_type == body_data.get('type')).group_by(SensorData.value).order_by(desc('total'))
     if body_data.get('start', None):
@@ -349,7 +475,7 @@ def request_device_readings_mode(device_uuid):
         query = query.filter(SensorData.date_created <= body_data.get('end'))
 
     row = query.first()
-    return jsonify({ 'value': row[0] }), 200
+    return with_validators(jsonify({ 'value': row[0] }), etag, last_modified), 200
 
 @app.route('/devices/<string:device_uuid>/readings/quartiles/', methods = ['GET'])
 def request_device_readings_quartiles(device_uuid):
@@ -374,6 +500,10 @@ def request_device_readings_quartiles(device_uuid):
 
     body_data = json.loads(request.data)
 
+    etag, last_modified = device_validators(device_uuid, body_data.get('type'))
+    if not_modified(etag):
+        return not_modified_response(etag, last_modified)
+
     subquery = SensorData.query.filter(SensorData.device_uuid == device_uuid, SensorData.sensor_type == body_data.get('type'))
     if body_data.get('start', None):
         subquery = subquery.filter(SensorData.date_created >= body_data.get('start'))
@@ -411,7 +541,7 @@ def request_device_readings_quartiles(device_uuid):
         q1_row = q1_query.first()
         q3_row = q3_query.first()
 
-    return jsonify({'quartile_1': q1_row.value, 'quartile_3': q3_row.value}), 200
+    return with_validators(jsonify({'quartile_1': q1_row.value, 'quartile_3': q3_row.value}), etag, last_modified), 200
 
 
 if __name__ == '__main__':
@@ -4,6 +4,9 @@ class Config(object):
     TESTING = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///database.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    COMPRESSION_MIN_SIZE = 500
+    COMPRESSION_LEVEL = 6
+    BROTLI_QUALITY = 4
 
 class DevelopmentConfig(Config):
     ENV = 'Development'
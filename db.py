@@ -7,4 +7,5 @@ class DataAccessLayer:
         self.db = SQLAlchemy(app)
         self.engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'], echo=True)
         self.engine.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        self.engine.execute('CREATE TABLE IF NOT EXISTS device_markers (device_uuid TEXT, type TEXT, sequence INTEGER, last_modified INTEGER, PRIMARY KEY (device_uuid, type))')
         self.Session = sessionmaker(bind = self.engine)
@@ -1,3 +1,4 @@
+import gzip
 import json
 import sqlite3
 import time
@@ -5,6 +6,11 @@ import unittest
 
 from app import app
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 class SensorRoutesTestCases(unittest.TestCase):
 
     def setUp(self):
@@ -12,6 +18,8 @@ class SensorRoutesTestCases(unittest.TestCase):
         conn = sqlite3.connect('test_database.db')
         conn.execute('DROP TABLE IF EXISTS readings')
         conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.execute('DROP TABLE IF EXISTS device_markers')
+        conn.execute('CREATE TABLE IF NOT EXISTS device_markers (device_uuid TEXT, type TEXT, sequence INTEGER, last_modified INTEGER, PRIMARY KEY (device_uuid, type))')
         
         self.device_uuid = 'test_device'
 
@@ -225,4 +233,135 @@ class SensorRoutesTestCases(unittest.TestCase):
 
         self.assertEqual(reading.get('quartile_1'), 22)
         self.assertEqual(reading.get('quartile_3'), 75)
-        
+
+    def test_device_readings_get_not_modified(self):
+        # Given a device with a reading ingested through the API
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=
+            json.dumps({
+                'type': 'temperature',
+                'value': 30
+            }))
+
+        # When we request its readings
+        response = self.client().get('/devices/{}/readings/'.format(self.device_uuid))
+
+        # Then we should receive validators
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        self.assertIsNotNone(response.headers.get('Last-Modified'))
+
+        # And re-polling with the same tag should return an empty 304
+        response = self.client().get('/devices/{}/readings/'.format(self.device_uuid),
+            headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_device_readings_post_invalidates_etag(self):
+        # Given a device with a reading ingested through the API
+        data = json.dumps({
+            'type': 'temperature',
+            'value': 30
+        })
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=data)
+        response = self.client().get('/devices/{}/readings/mean/'.format(self.device_uuid), data=
+            json.dumps({
+                'type': 'temperature'
+            }))
+        etag = response.headers.get('ETag')
+        self.assertIsNotNone(etag)
+
+        # When a new reading is ingested for the same device and type
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=data)
+
+        # Then the previous tag should no longer match
+        response = self.client().get('/devices/{}/readings/mean/'.format(self.device_uuid), data=
+            json.dumps({
+                'type': 'temperature'
+            }), headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers.get('ETag'), etag)
+
+    def test_device_readings_modified_since_different_query(self):
+        # Given a device with readings of both types ingested through the API
+        for sensor_type in ['temperature', 'humidity']:
+            self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=
+                json.dumps({
+                    'type': sensor_type,
+                    'value': 30
+                }))
+        response = self.client().get('/devices/{}/readings/mean/'.format(self.device_uuid), data=
+            json.dumps({
+                'type': 'temperature'
+            }))
+        last_modified = response.headers.get('Last-Modified')
+        self.assertIsNotNone(last_modified)
+
+        # When we query a different type on the same path with only If-Modified-Since
+        response = self.client().get('/devices/{}/readings/mean/'.format(self.device_uuid), data=
+            json.dumps({
+                'type': 'humidity'
+            }), headers={'If-Modified-Since': last_modified})
+
+        # Then we should receive the humidity mean rather than a 304
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data).get('value'), 50.5)
+
+    def test_device_readings_modified_since_same_second(self):
+        # Given a device with a reading ingested through the API
+        data = json.dumps({
+            'type': 'temperature',
+            'value': 30
+        })
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=data)
+        response = self.client().get('/devices/{}/readings/mean/'.format(self.device_uuid), data=
+            json.dumps({
+                'type': 'temperature'
+            }))
+        last_modified = response.headers.get('Last-Modified')
+        self.assertIsNotNone(last_modified)
+
+        # When a second reading is ingested within the same second
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=data)
+
+        # Then revalidating with If-Modified-Since should return the new mean
+        response = self.client().get('/devices/{}/readings/mean/'.format(self.device_uuid), data=
+            json.dumps({
+                'type': 'temperature'
+            }), headers={'If-Modified-Since': last_modified})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertAlmostEqual(json.loads(response.data).get('value'), 254 / 6)
+
+    def test_device_readings_get_gzip(self):
+        response = self.client().get('/devices/{}/readings/'.format(self.device_uuid),
+            headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+
+        readings = json.loads(gzip.decompress(response.data))
+        self.assertEqual(len(readings), 7)
+
+    @unittest.skipIf(brotli is None, 'brotli is not installed')
+    def test_device_readings_get_brotli(self):
+        response = self.client().get('/devices/{}/readings/'.format(self.device_uuid),
+            headers={'Accept-Encoding': 'br, gzip'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get('Content-Encoding'), 'br')
+
+        readings = json.loads(brotli.decompress(response.data))
+        self.assertEqual(len(readings), 7)
+
+    def test_device_readings_small_body_uncompressed(self):
+        response = self.client().get('/devices/{}/readings/mean/'.format(self.device_uuid), data=
+            json.dumps({
+                'type': 'temperature'
+            }), headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+        self.assertEqual(json.loads(response.data).get('value'), 48.5)